@@ -1,11 +1,20 @@
 import os
-import json
+import asyncio
+import hashlib
 import logging
-from datetime import datetime
-from typing import List, Dict
-
+import queue
+from collections import OrderedDict
+from contextlib import aclosing, suppress
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import AsyncIterator, Awaitable, Callable, List, Dict, Optional, Tuple
+
+import httpx
+import numpy as np
+import orjson
 from dotenv import load_dotenv
 from telegram import (
+    CallbackQuery,
+    Message,
     Update,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
@@ -13,6 +22,7 @@ from telegram import (
     KeyboardButton,
 )
 from telegram.ext import (
+    AIORateLimiter,
     Application,
     CommandHandler,
     MessageHandler,
@@ -20,7 +30,9 @@ from telegram.ext import (
     ContextTypes,
     filters,
 )
-from openai import OpenAI
+import openai
+from openai import AsyncOpenAI
+from tenacity import AsyncRetrying, retry_if_exception, stop_after_attempt, wait_random_exponential
 
 
 # ------------------ базовая настройка ------------------
@@ -30,7 +42,17 @@ OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 assert TELEGRAM_TOKEN, "TELEGRAM_TOKEN is missing"
 assert OPENAI_API_KEY, "OPENAI_API_KEY is missing"
 
-client = OpenAI(api_key=OPENAI_API_KEY)
+# общий пул соединений: keep-alive экономит TCP+TLS рукопожатие на каждом запросе
+http_client = httpx.AsyncClient(
+    limits=httpx.Limits(max_keepalive_connections=50, max_connections=200, keepalive_expiry=60.0),
+    http2=True,
+    timeout=httpx.Timeout(60.0, connect=5.0),
+)
+client = AsyncOpenAI(api_key=OPENAI_API_KEY, http_client=http_client)
+# для чата повторы делает tenacity (llm_retrying), встроенные ретраи SDK отключены
+chat_client = client.with_options(max_retries=0)
+# ограничиваем число одновременных запросов к OpenAI
+llm_semaphore = asyncio.Semaphore(64)
 
 logging.basicConfig(
     format="%(asctime)s %(levelname)s %(name)s | %(message)s",
@@ -41,17 +63,34 @@ logger = logging.getLogger("vr-bot")
 
 # ------------------ данные персон ------------------
 def load_default_persona() -> Dict:
-    with open("persona.json", "r", encoding="utf-8") as f:
-        return json.load(f)
+    with open("persona.json", "rb") as f:
+        return orjson.loads(f.read())
 
 
 def load_personas() -> List[Dict]:
-    with open("personas_library.json", "r", encoding="utf-8") as f:
-        return json.load(f)
+    with open("personas_library.json", "rb") as f:
+        return orjson.loads(f.read())
 
 
 DEFAULT_PERSONA = load_default_persona()
 PERSONAS = load_personas()
+PERSONAS_BY_ID = {p["id"]: p for p in PERSONAS}
+
+PERSONA_CB_PREFIX = "persona:"
+
+PERSONA_KEYBOARD = InlineKeyboardMarkup(
+    [[InlineKeyboardButton(p["title"], callback_data=f"{PERSONA_CB_PREFIX}{p['id']}")] for p in PERSONAS]
+    + [[InlineKeyboardButton("Назад", callback_data="back_home")]]
+)
+
+# reply-кнопка для быстрого рестарта
+START_REPLY_KB = ReplyKeyboardMarkup([[KeyboardButton("🔄 Начать заново")]], resize_keyboard=True)
+
+START_INLINE_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🧑‍🎤 Выбрать персону", callback_data="pick_persona")],
+    [InlineKeyboardButton("💬 Начать чат", callback_data="begin_chat")],
+    [InlineKeyboardButton("📄 Сводка (/summary)", callback_data="summary_hint")],
+])
 
 
 # ------------------ утилиты истории чата ------------------
@@ -66,149 +105,408 @@ def get_user_state(context: ContextTypes.DEFAULT_TYPE) -> Dict:
             "persona_prompt": DEFAULT_PERSONA["prompt"],
             "segment_details": "",
             "awaiting_segment_details": False,
-            "history": []
+            # messages[0] — системный промпт, дальше последние MAX_HISTORY реплик
+            "messages": [{"role": "system", "content": ""}],
+            # не даёт одному пользователю перемешать историю параллельными запросами
+            "lock": asyncio.Lock(),
         }
+        update_system_prompt(context.user_data["state"])
     return context.user_data["state"]
 
 
+def update_system_prompt(state: Dict):
+    # собираем системный промпт один раз при смене персоны/сегмента:
+    # неизменный префикс сообщений попадает в prompt caching OpenAI
+    system_prompt = state["persona_prompt"]
+    if state.get("segment_details"):
+        system_prompt += f"\nКонтекст уточнения аудитории: {state['segment_details']}"
+    state["messages"][0]["content"] = system_prompt
+
+
 def push_history(state: Dict, role: str, content: str):
-    state["history"].append({"role": role, "content": content})
-    while len(state["history"]) > MAX_HISTORY:
-        state["history"].pop(0)
+    messages = state["messages"]
+    messages.append({"role": role, "content": content})
+    excess = len(messages) - 1 - MAX_HISTORY
+    if excess > 0:
+        del messages[1:1 + excess]
 
 
-def history_to_messages(state: Dict) -> List[Dict]:
-    persona_prompt = state["persona_prompt"]
-    if state.get("segment_details"):
-        persona_prompt += f"\nКонтекст уточнения аудитории: {state['segment_details']}"
-    msgs = [{"role": "system", "content": persona_prompt}]
-    msgs.extend(state["history"])
-    return msgs
+def clear_history(state: Dict):
+    del state["messages"][1:]
+
+
+USER_LOG_FILES_MAX = 512  # столько файлов логов держим открытыми одновременно
+
+
+class UserLogRouter(logging.Handler):
+    # раскладывает записи чата по logs/{user_id}.log; вызывается только из потока QueueListener
+    def __init__(self):
+        super().__init__()
+        self.user_handlers: "OrderedDict[int, RotatingFileHandler]" = OrderedDict()
+
+    def get_user_handler(self, user_id: int) -> RotatingFileHandler:
+        handler = self.user_handlers.get(user_id)
+        if handler is not None:
+            self.user_handlers.move_to_end(user_id)
+            return handler
+
+        os.makedirs("logs", exist_ok=True)
+        handler = RotatingFileHandler(
+            os.path.join("logs", f"{user_id}.log"),
+            maxBytes=1_000_000,
+            backupCount=3,
+            encoding="utf-8",
+        )
+        handler.setFormatter(logging.Formatter("[%(asctime)s] %(message)s", datefmt="%Y-%m-%dT%H:%M:%S"))
+
+        self.user_handlers[user_id] = handler
+        if len(self.user_handlers) > USER_LOG_FILES_MAX:
+            _, evicted = self.user_handlers.popitem(last=False)
+            evicted.close()
+        return handler
+
+    def emit(self, record: logging.LogRecord):
+        try:
+            self.get_user_handler(record.user_id).handle(record)
+        except Exception:
+            self.handleError(record)
+
+    def close(self):
+        for handler in self.user_handlers.values():
+            handler.close()
+        self.user_handlers.clear()
+        super().close()
+
+
+# запись на диск идёт в отдельном потоке QueueListener, а не в event loop
+CHAT_LOG_QUEUE: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+chat_log_router = UserLogRouter()
+chat_log_listener = QueueListener(CHAT_LOG_QUEUE, chat_log_router)
+
+chat_logger = logging.getLogger("vr-bot.chat")
+chat_logger.setLevel(logging.INFO)
+chat_logger.propagate = False
+chat_logger.addHandler(QueueHandler(CHAT_LOG_QUEUE))
 
 
 def log_chat(user_id: int, user_text: str, bot_text: str):
-    os.makedirs("logs", exist_ok=True)
-    path = os.path.join("logs", f"{user_id}.log")
-    with open(path, "a", encoding="utf-8") as f:
-        f.write(f"[{datetime.now().isoformat(timespec='seconds')}] USER: {user_text}\n")
-        f.write(f"[{datetime.now().isoformat(timespec='seconds')}] BOT : {bot_text}\n\n")
+    extra = {"user_id": user_id}
+    chat_logger.info("USER: %s", user_text, extra=extra)
+    chat_logger.info("BOT : %s\n", bot_text, extra=extra)
 
 
 # ------------------ OpenAI вызовы ------------------
-async def call_llm(messages: List[Dict], max_tokens: int = 200) -> str:
-    resp = client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=messages,
-        max_tokens=max_tokens,
-        temperature=0.8,
+RESPONSE_CACHE_SIZE = 5000
+RESPONSE_CACHE: "OrderedDict[str, str]" = OrderedDict()
+
+
+def messages_key(messages: List[Dict]) -> str:
+    raw = orjson.dumps(messages, option=orjson.OPT_SORT_KEYS)
+    return hashlib.blake2b(raw, digest_size=16).hexdigest()
+
+
+def get_cached_response(key: str) -> Optional[str]:
+    text = RESPONSE_CACHE.get(key)
+    if text is not None:
+        RESPONSE_CACHE.move_to_end(key)
+    return text
+
+
+def store_response(key: str, text: str):
+    RESPONSE_CACHE[key] = text
+    if len(RESPONSE_CACHE) > RESPONSE_CACHE_SIZE:
+        RESPONSE_CACHE.popitem(last=False)
+
+
+RETRYABLE_STATUS_CODES = frozenset({408, 409})  # остальные статусы, которые повторяет сам SDK
+
+
+def is_retryable_llm_error(exc: BaseException) -> bool:
+    if isinstance(exc, (
+        openai.RateLimitError,
+        openai.APITimeoutError,
+        openai.APIConnectionError,
+        openai.InternalServerError,
+    )):
+        return True
+    return isinstance(exc, openai.APIStatusError) and exc.status_code in RETRYABLE_STATUS_CODES
+
+
+def llm_retrying() -> AsyncRetrying:
+    # 408/409/429/5xx/обрывы соединения повторяем с экспоненциальной задержкой и джиттером
+    return AsyncRetrying(
+        wait=wait_random_exponential(min=0.5, max=8),
+        stop=stop_after_attempt(5),
+        retry=retry_if_exception(is_retryable_llm_error),
+        reraise=True,
     )
-    return resp.choices[0].message.content.strip()
+
+
+async def call_llm(messages: List[Dict], max_tokens: int = 200, use_cache: bool = True) -> str:
+    key = messages_key(messages) if use_cache else None
+    if key is not None:
+        cached = get_cached_response(key)
+        if cached is not None:
+            return cached
+
+    async for attempt in llm_retrying():
+        with attempt:
+            async with llm_semaphore:
+                resp = await chat_client.chat.completions.create(
+                    model="gpt-4o-mini",
+                    messages=messages,
+                    max_tokens=max_tokens,
+                    temperature=0.8,
+                )
+    text = resp.choices[0].message.content.strip()
+
+    if key is not None:
+        store_response(key, text)
+    return text
+
+
+async def read_completion_stream(messages: List[Dict], max_tokens: int, deltas: "asyncio.Queue[Optional[str]]"):
+    # кладёт куски ответа в очередь, в конце — None
+    try:
+        stream_error = None
+        async for attempt in llm_retrying():
+            with attempt:
+                async with llm_semaphore:
+                    stream = await chat_client.chat.completions.create(
+                        model="gpt-4o-mini",
+                        messages=messages,
+                        max_tokens=max_tokens,
+                        temperature=0.8,
+                        stream=True,
+                    )
+                    # async with закрывает ответ и при ошибке/отмене, иначе соединение не вернётся в пул
+                    async with stream:
+                        sent_any = False
+                        try:
+                            async for chunk in stream:
+                                delta = chunk.choices[0].delta.content if chunk.choices else None
+                                if delta:
+                                    deltas.put_nowait(delta)
+                                    sent_any = True
+                        except Exception as e:
+                            # до первого куска ошибку отдаём tenacity на повтор;
+                            # после — не повторяем: начало ответа уже ушло пользователю
+                            if not sent_any:
+                                raise
+                            stream_error = e
+        if stream_error is not None:
+            raise stream_error
+    finally:
+        deltas.put_nowait(None)
+
+
+async def stream_llm(messages: List[Dict], max_tokens: int = 200) -> AsyncIterator[str]:
+    # отдаём ответ кусками по мере генерации; из кэша — одним куском
+    key = messages_key(messages)
+    cached = get_cached_response(key)
+    if cached is not None:
+        yield cached
+        return
+
+    # поток читает отдельная задача: слот семафора занят только на время запроса
+    # к OpenAI, а не пока вызывающий код ждёт правки сообщения в Telegram
+    deltas: "asyncio.Queue[Optional[str]]" = asyncio.Queue()
+    reader = asyncio.create_task(read_completion_stream(messages, max_tokens, deltas))
+    parts = []
+    try:
+        while (delta := await deltas.get()) is not None:
+            parts.append(delta)
+            yield delta
+        await reader  # пробрасываем ошибку запроса, если она была
+    finally:
+        reader.cancel()
+        # забираем результат задачи, чтобы её ошибка не ушла в "exception was never retrieved"
+        with suppress(asyncio.CancelledError, Exception):
+            await reader
+
+    text = "".join(parts).strip()
+    if text:
+        store_response(key, text)
+
+
+# ------------------ семантический кэш ответов ------------------
+SEMANTIC_GROUPS_MAX = 40  # пар (persona_id, segment_details) в кэше
+SEMANTIC_GROUP_SIZE = 256  # ответов на одну пару, старые перезаписываются по кругу
+SEMANTIC_THRESHOLD = 0.92
+EMBEDDING_CACHE_SIZE = 10_000
+
+# (persona_id, segment_details) -> {"vectors": матрица нормированных эмбеддингов,
+# "answers": ответы в тех же строках, "size": заполнено строк, "next": куда писать}
+SEMANTIC_CACHE: "OrderedDict[Tuple, Dict]" = OrderedDict()
+EMBEDDING_CACHE: "OrderedDict[str, np.ndarray]" = OrderedDict()
+
+
+async def embed_text(text: str) -> np.ndarray:
+    vec = EMBEDDING_CACHE.get(text)
+    if vec is not None:
+        EMBEDDING_CACHE.move_to_end(text)
+        return vec
+
+    async with llm_semaphore:
+        resp = await client.embeddings.create(model="text-embedding-3-small", input=text)
+    vec = np.asarray(resp.data[0].embedding, dtype=np.float32)
+    vec /= np.linalg.norm(vec)  # после нормировки косинус = скалярное произведение
+
+    EMBEDDING_CACHE[text] = vec
+    if len(EMBEDDING_CACHE) > EMBEDDING_CACHE_SIZE:
+        EMBEDDING_CACHE.popitem(last=False)
+    return vec
+
+
+def semantic_lookup(cache_key: Tuple, emb: np.ndarray) -> Optional[str]:
+    group = SEMANTIC_CACHE.get(cache_key)
+    if group is None:
+        return None
+    SEMANTIC_CACHE.move_to_end(cache_key)
+
+    # одно матрично-векторное произведение по ответам только этой персоны/сегмента
+    scores = group["vectors"][:group["size"]] @ emb
+    best = int(np.argmax(scores))
+    if scores[best] <= SEMANTIC_THRESHOLD:
+        return None
+    return group["answers"][best]
+
+
+def semantic_store(cache_key: Tuple, emb: np.ndarray, answer: str):
+    group = SEMANTIC_CACHE.get(cache_key)
+    if group is None:
+        group = {
+            "vectors": np.empty((SEMANTIC_GROUP_SIZE, emb.shape[0]), dtype=np.float32),
+            "answers": [None] * SEMANTIC_GROUP_SIZE,
+            "size": 0,
+            "next": 0,
+        }
+        SEMANTIC_CACHE[cache_key] = group
+        if len(SEMANTIC_CACHE) > SEMANTIC_GROUPS_MAX:
+            SEMANTIC_CACHE.popitem(last=False)
+    SEMANTIC_CACHE.move_to_end(cache_key)
+
+    i = group["next"]
+    group["vectors"][i] = emb
+    group["answers"][i] = answer
+    group["next"] = (i + 1) % SEMANTIC_GROUP_SIZE
+    group["size"] = min(group["size"] + 1, SEMANTIC_GROUP_SIZE)
 
 
 # ------------------ handlers ------------------
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     state = get_user_state(context)
-    state.update({
-        "persona_id": None,
-        "persona_title": None,
-        "persona_prompt": DEFAULT_PERSONA["prompt"],
-        "segment_details": "",
-        "awaiting_segment_details": False,
-        "history": []
-    })
-
-    # reply-кнопка для быстрого рестарта
-    reply_keyboard = [[KeyboardButton("🔄 Начать заново")]]
-
-    inline_keyboard = [
-        [InlineKeyboardButton("🧑‍🎤 Выбрать персону", callback_data="pick_persona")],
-        [InlineKeyboardButton("💬 Начать чат", callback_data="begin_chat")],
-        [InlineKeyboardButton("📄 Сводка (/summary)", callback_data="summary_hint")],
-    ]
+    async with state["lock"]:
+        state.update({
+            "persona_id": None,
+            "persona_title": None,
+            "persona_prompt": DEFAULT_PERSONA["prompt"],
+            "segment_details": "",
+            "awaiting_segment_details": False,
+        })
+        clear_history(state)
+        update_system_prompt(state)
 
     await update.message.reply_text(
         "Привет! Я — «Виртуальный респондент».\n"
         "• Выбери персону (или оставь по умолчанию)\n"
         "• Напиши любой вопрос — отвечу от первого лица\n"
         "• В конце используй /summary для итогов",
-        reply_markup=ReplyKeyboardMarkup(reply_keyboard, resize_keyboard=True)
+        reply_markup=START_REPLY_KB
     )
 
     await update.message.reply_text(
         "Выбери действие:",
-        reply_markup=InlineKeyboardMarkup(inline_keyboard),
+        reply_markup=START_INLINE_KB,
     )
 
 
+PERSONA_QUESTIONS: Dict[str, str] = {
+    "young_mom_moscow": (
+        "Чтобы ответы респондента звучали реалистично и соответствовали задачам исследования, "
+        "укажи ключевой критерий сегмента, который важен именно для твоего исследования.\n\n"
+        "✍️ Напиши коротко: какой именно подтип аудитории тебе нужен и чем он важен для теста.\n\n"
+        "Примеры признаков:\n• возраст ребёнка\n• семейное положение\n• занятость\n• тип жилья\n• интересы\n• уровень дохода семьи"
+    ),
+    "it_engineer": (
+        "Чтобы ответы респондента звучали реалистично и соответствовали задачам исследования, "
+        "укажи ключевой критерий сегмента, который важен именно для твоего исследования.\n\n"
+        "✍️ Напиши коротко: какой именно подтип аудитории тебе нужен и чем он важен для теста.\n\n"
+        "Примеры признаков:\n• специализация\n• уровень (junior, middle, senior)\n• формат работы\n• страна\n• тип компании\n• приоритеты"
+    ),
+    "smb_owner": (
+        "Чтобы ответы респондента звучали реалистично и соответствовали задачам исследования, "
+        "укажи ключевой критерий сегмента, который важен именно для твоего исследования.\n\n"
+        "✍️ Напиши коротко: какой именно подтип аудитории тебе нужен и чем он важен для теста.\n\n"
+        "Примеры признаков:\n• отрасль\n• размер бизнеса и команды\n• стаж предпринимателя\n• регион\n• модель бизнеса"
+    ),
+}
+
+
 def get_persona_question(persona_id: str) -> str:
-    questions = {
-        "young_mom_moscow": (
-            "Чтобы ответы респондента звучали реалистично и соответствовали задачам исследования, "
-            "укажи ключевой критерий сегмента, который важен именно для твоего исследования.\n\n"
-            "✍️ Напиши коротко: какой именно подтип аудитории тебе нужен и чем он важен для теста.\n\n"
-            "Примеры признаков:\n• возраст ребёнка\n• семейное положение\n• занятость\n• тип жилья\n• интересы\n• уровень дохода семьи"
-        ),
-        "it_engineer": (
-            "Чтобы ответы респондента звучали реалистично и соответствовали задачам исследования, "
-            "укажи ключевой критерий сегмента, который важен именно для твоего исследования.\n\n"
-            "✍️ Напиши коротко: какой именно подтип аудитории тебе нужен и чем он важен для теста.\n\n"
-            "Примеры признаков:\n• специализация\n• уровень (junior, middle, senior)\n• формат работы\n• страна\n• тип компании\n• приоритеты"
-        ),
-        "smb_owner": (
-            "Чтобы ответы респондента звучали реалистично и соответствовали задачам исследования, "
-            "укажи ключевой критерий сегмента, который важен именно для твоего исследования.\n\n"
-            "✍️ Напиши коротко: какой именно подтип аудитории тебе нужен и чем он важен для теста.\n\n"
-            "Примеры признаков:\n• отрасль\n• размер бизнеса и команды\n• стаж предпринимателя\n• регион\n• модель бизнеса"
-        ),
-    }
-    return questions.get(persona_id, "Опиши, пожалуйста, уточнения по сегменту целевой аудитории.")
+    return PERSONA_QUESTIONS.get(persona_id, "Опиши, пожалуйста, уточнения по сегменту целевой аудитории.")
 
 
-async def on_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-    state = get_user_state(context)
+async def cb_pick_persona(query: CallbackQuery, state: Dict):
+    await query.edit_message_text("Выбери персону:", reply_markup=PERSONA_KEYBOARD)
 
-    if query.data == "pick_persona":
-        rows = []
-        for p in PERSONAS:
-            rows.append([InlineKeyboardButton(p["title"], callback_data=f"persona:{p['id']}")])
-        rows.append([InlineKeyboardButton("Назад", callback_data="back_home")])
-        await query.edit_message_text("Выбери персону:", reply_markup=InlineKeyboardMarkup(rows))
-        return
 
-    if query.data.startswith("persona:"):
-        persona_id = query.data.split(":", 1)[1]
-        persona = next((p for p in PERSONAS if p["id"] == persona_id), None)
-        if persona:
+async def cb_persona(query: CallbackQuery, state: Dict):
+    persona_id = query.data[len(PERSONA_CB_PREFIX):]
+    persona = PERSONAS_BY_ID.get(persona_id)
+    if persona:
+        async with state["lock"]:
             state["persona_id"] = persona_id
             state["persona_title"] = persona["title"]
             state["persona_prompt"] = persona["prompt"]
-            state["history"].clear()
+            clear_history(state)
             state["segment_details"] = ""
             state["awaiting_segment_details"] = True
+            update_system_prompt(state)
 
-            question_text = get_persona_question(persona_id)
-            await query.edit_message_text(
-                f"Персона установлена: *{persona['title']}*.\n\n{question_text}",
-                parse_mode="Markdown"
-            )
-        else:
-            await query.edit_message_text("Не нашёл такую персону. Попробуй ещё раз.")
-        return
+        question_text = get_persona_question(persona_id)
+        await query.edit_message_text(
+            f"Персона установлена: *{persona['title']}*.\n\n{question_text}",
+            parse_mode="Markdown"
+        )
+    else:
+        await query.edit_message_text("Не нашёл такую персону. Попробуй ещё раз.")
 
-    if query.data == "begin_chat":
-        await query.edit_message_text("Ок, пиши вопрос. Я отвечу от лица выбранной персоны.")
-        return
 
-    if query.data == "summary_hint":
-        await query.edit_message_text("В конце сеанса отправь команду /summary — соберу выводы и инсайты.")
-        return
+async def cb_begin_chat(query: CallbackQuery, state: Dict):
+    await query.edit_message_text("Ок, пиши вопрос. Я отвечу от лица выбранной персоны.")
+
+
+async def cb_summary_hint(query: CallbackQuery, state: Dict):
+    await query.edit_message_text("В конце сеанса отправь команду /summary — соберу выводы и инсайты.")
 
-    if query.data == "back_home":
-        await query.edit_message_text("Готово. Можешь начать чат или выбрать персону.")
+
+async def cb_back_home(query: CallbackQuery, state: Dict):
+    await query.edit_message_text("Готово. Можешь начать чат или выбрать персону.")
+
+
+# callback_data -> обработчик; новые кнопки добавляются сюда
+CALLBACK_HANDLERS: Dict[str, Callable[[CallbackQuery, Dict], Awaitable[None]]] = {
+    "pick_persona": cb_pick_persona,
+    "begin_chat": cb_begin_chat,
+    "summary_hint": cb_summary_hint,
+    "back_home": cb_back_home,
+}
+
+
+async def on_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    state = get_user_state(context)
+
+    if query.data.startswith(PERSONA_CB_PREFIX):
+        await cb_persona(query, state)
         return
 
+    handler = CALLBACK_HANDLERS.get(query.data)
+    if handler:
+        await handler(query, state)
+
 
 async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
@@ -218,68 +516,129 @@ async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 
+RESTART_TOKENS = frozenset({"начать заново", "🔄 начать заново"})
+STREAM_EDIT_INTERVAL = 1.0  # сек; Telegram терпит примерно одну правку сообщения в секунду на чат
+
+
+async def stream_answer(msg: Message, messages: List[Dict]) -> str:
+    # дописываем ответ в уже отправленное сообщение по мере генерации
+    loop = asyncio.get_running_loop()
+    text, sent, last_edit = "", msg.text, loop.time()
+    async with aclosing(stream_llm(messages)) as deltas:
+        async for delta in deltas:
+            text += delta
+            # Telegram отклоняет правку, если текст не изменился
+            if loop.time() - last_edit >= STREAM_EDIT_INTERVAL and text.strip() not in ("", sent):
+                sent = text.strip()
+                await msg.edit_text(sent)
+                last_edit = loop.time()
+
+    answer = text.strip()
+    if answer != sent:
+        await msg.edit_text(answer)
+    return answer
+
+
 async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_text = update.message.text.strip()
-    state = get_user_state(context)
 
     # обработка кнопки «Начать заново»
-    if user_text.lower() in ["начать заново", "🔄 начать заново"]:
+    if user_text.casefold() in RESTART_TOKENS:
         await start(update, context)
         return
 
-    # если бот ждёт уточнение после выбора персоны
-    if state.get("awaiting_segment_details"):
-        state["awaiting_segment_details"] = False
-        state["segment_details"] = user_text
-        await update.message.reply_text(
-            "Отлично, контекст зафиксирован. Можешь начать задавать вопросы пользователю."
-        )
-        return
+    state = get_user_state(context)
 
-    # обычная логика чата
-    push_history(state, "user", user_text)
-    try:
-        answer = await call_llm(history_to_messages(state))
-    except Exception:
-        logger.exception("LLM error")
-        answer = "Хм, у меня сейчас сложности с ответом. Попробуй ещё раз через минуту."
-    push_history(state, "assistant", answer)
-    log_chat(update.effective_user.id, user_text, answer)
-    await update.message.reply_text(answer)
+    async with state["lock"]:
+        # если бот ждёт уточнение после выбора персоны
+        if state.get("awaiting_segment_details"):
+            state["awaiting_segment_details"] = False
+            state["segment_details"] = user_text
+            update_system_prompt(state)
+            await update.message.reply_text(
+                "Отлично, контекст зафиксирован. Можешь начать задавать вопросы пользователю."
+            )
+            return
+
+        # обычная логика чата
+        push_history(state, "user", user_text)
+        cache_key = (state["persona_id"], state["segment_details"])
+        emb = None
+        # ответ на продолжение диалога зависит от истории, поэтому
+        # семантический кэш используем только для первого вопроса
+        if len(state["messages"]) == 2:
+            try:
+                emb = await embed_text(user_text)
+            except Exception:
+                logger.exception("Embedding error")
+
+        answer = semantic_lookup(cache_key, emb) if emb is not None else None
+        if answer is not None:
+            await update.message.reply_text(answer)
+        else:
+            msg = await update.message.reply_text("…")
+            try:
+                answer = await stream_answer(msg, state["messages"])
+                if emb is not None:
+                    semantic_store(cache_key, emb, answer)
+            except Exception:
+                logger.exception("LLM error")
+                answer = "Хм, у меня сейчас сложности с ответом. Попробуй ещё раз через минуту."
+                await msg.edit_text(answer)
+        push_history(state, "assistant", answer)
+        log_chat(update.effective_user.id, user_text, answer)
 
 
 async def summary(update: Update, context: ContextTypes.DEFAULT_TYPE):
     state = get_user_state(context)
-    if not state["history"]:
-        await update.message.reply_text("Пока нечего суммировать — напиши пару вопросов.")
-        return
+    async with state["lock"]:
+        if len(state["messages"]) == 1:
+            await update.message.reply_text("Пока нечего суммировать — напиши пару вопросов.")
+            return
+
+        persona_title = state.get("persona_title", "Без персоны")
+        segment_details = state.get("segment_details", "")
+        summary_intro = f"Отчёт по персоне: *{persona_title}*"
+        if segment_details:
+            summary_intro += f"\nУточнение сегмента: {segment_details}"
+
+        msgs = [
+            *state["messages"],
+            {"role": "user", "content":
+                "Сделай краткий отчёт по нашей беседе: 3–5 пунктов инсайтов, что понравилось/не понравилось, "
+                "ожидания/триггеры, и 3 тестовых next steps для продукта. Формат — маркированный список."}
+        ]
+        try:
+            report = await call_llm(msgs, max_tokens=350, use_cache=False)
+        except Exception:
+            logger.exception("LLM summary error")
+            report = "Не удалось собрать сводку. Попробуй ещё раз позже."
+
+        log_chat(update.effective_user.id, "[/summary]", report)
+        await update.message.reply_text(f"{summary_intro}\n\n📄 Итоги:\n{report}", parse_mode="Markdown")
 
-    persona_title = state.get("persona_title", "Без персоны")
-    segment_details = state.get("segment_details", "")
-    summary_intro = f"Отчёт по персоне: *{persona_title}*"
-    if segment_details:
-        summary_intro += f"\nУточнение сегмента: {segment_details}"
-
-    msgs = [
-        {"role": "system", "content": state["persona_prompt"]},
-        *state["history"],
-        {"role": "user", "content":
-            "Сделай краткий отчёт по нашей беседе: 3–5 пунктов инсайтов, что понравилось/не понравилось, "
-            "ожидания/триггеры, и 3 тестовых next steps для продукта. Формат — маркированный список."}
-    ]
-    try:
-        report = await call_llm(msgs, max_tokens=350)
-    except Exception:
-        logger.exception("LLM summary error")
-        report = "Не удалось собрать сводку. Попробуй ещё раз позже."
 
-    log_chat(update.effective_user.id, "[/summary]", report)
-    await update.message.reply_text(f"{summary_intro}\n\n📄 Итоги:\n{report}", parse_mode="Markdown")
+# ------------------ запуск ------------------
+async def on_startup(app: Application):
+    chat_log_listener.start()
+
+
+async def on_shutdown(app: Application):
+    chat_log_listener.stop()  # дописывает всё, что осталось в очереди
+    chat_log_router.close()
+    await http_client.aclose()
 
 
-# ------------------ запуск ------------------
 def main():
-    app = Application.builder().token(TELEGRAM_TOKEN).build()
+    app = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        .concurrent_updates(256)
+        .rate_limiter(AIORateLimiter(overall_max_rate=28, overall_time_period=1, max_retries=3))
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
 
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("help", help_cmd))